@@ -4,15 +4,22 @@ Note that we do not simply append to the NWB 2.0 file that is output from suite2
 once an NWB file is created, some properties cannot be changed, such as the identifier, session_description,
 file_create_date, and session_start_time. In order to preserve these properties, we create a new NWB 2.0 file
 that contains the data from the NWB 1.0 file and the suite2p output NWB 2.0 file.
+
+By default, the new NWB 2.0 file is standalone: the datasets from the suite2p output NWB 2.0 file are copied into it.
+With the --link_data option, most of these datasets, including the raw TwoPhotonSeries data, are not copied. Instead,
+the new file contains HDF5 external links to them, so the suite2p output file must be kept alongside the new file (at
+the same relative path).
 """
 from datetime import datetime, timezone
 import h5py
 import numpy as np
 from pathlib import Path
-from pynwb import NWBHDF5IO, NWBFile, TimeSeries  # , H5DataIO
+from hdmf.common import DynamicTableRegion, VectorIndex
+from pynwb import NWBHDF5IO, NWBFile, TimeSeries, H5DataIO
 
 # from pynwb.base import Images
 from pynwb.behavior import BehavioralTimeSeries
+from pynwb.device import Device
 from pynwb.file import Subject
 from pynwb.image import OpticalSeries, IndexSeries
 
@@ -22,8 +29,19 @@ import pytz
 import argparse
 import os
 
-def main(path_nwb_1, path_nwb_2, path_output):
-    """Main function."""
+# the intermediate file is kept in memory unless the NWB 1 datasets that are copied into it are larger than this
+_MAX_IN_MEMORY_TEMP_BYTES = 1024**3
+
+# map the values of subject sex in the NWB 1 file to the values recommended by NWB 2 best practices
+_SEX_MAP = {"male": "M", "female": "F"}
+
+
+def main(path_nwb_1, path_nwb_2, path_output, link_data=False):
+    """Main function.
+
+    If link_data is True, most datasets from the suite2p output file are linked to instead of copied into the output
+    file. Datasets that hold object references are always copied (see copy_reference_datasets).
+    """
     old_nwb_path = path_nwb_1
     suite2p_out_path = path_nwb_2
     temp_merged_path = os.path.join(os.path.split(path_output)[0], 'temp.nwb')
@@ -35,50 +53,107 @@ def main(path_nwb_1, path_nwb_2, path_output):
 
         # open the NWB 1 file using h5py
         # this code assumes that relevant data lives in particular places and only those places
-        with h5py.File(old_nwb_path) as f:
+        # the file must stay open until out_nwbfile is written because some of its datasets are copied on write
+        with h5py.File(old_nwb_path, "r") as f:
+            # look up the groups that are used by the helper functions once, so that each helper function only
+            # needs to resolve paths relative to these groups
+            old_processing = f["/processing/brain_observatory_pipeline"]
+            old_templates = f["/stimulus/templates"]
+            old_presentations = f["/stimulus/presentation"]
+            old_general = f["/general"]
+            old_subject = old_general["subject"]
+
             out_nwbfile = create_out_nwbfile(f, in_nwbfile)
-            add_running_speed_timeseries(out_nwbfile, f)
+            add_running_speed_timeseries(out_nwbfile, old_processing)
             # TODO add pupil tracking
             # TODO add eye tracking
-            add_stimuli(out_nwbfile, f)
-            add_subject(out_nwbfile, f)
-            add_general(out_nwbfile, f)
+            add_stimuli(out_nwbfile, old_templates, old_presentations)
+            add_subject(out_nwbfile, old_subject)
+            add_general(out_nwbfile, old_general)
 
             # TODO add imaging plane
             # TODO how is the imaging plane in NWB 1 file different from the one in suite2p file?
             # NOTE the raw acquisition data is omitted
 
-        # NOTE in order to add elements from the NWB 2 file into a new file, the new file must
-        # first be created, then read, then have elements added to it, then exported to a new file.
-        # this is not the most efficient, but it works.
-        with NWBHDF5IO(temp_merged_path, "w") as merged_io_write:
-            merged_io_write.write(out_nwbfile)
-
-        with NWBHDF5IO(temp_merged_path, "r") as merged_io_read:
-            export_nwbfile = merged_io_read.read()
-
-            # TODO fix transpose of data in suite2p output
-            # see https://github.com/MouseLand/suite2p/issues/909
-            add_suite2p_output(export_nwbfile, in_nwbfile)
-
-            with NWBHDF5IO(export_path, "w") as export_merged_io:
-                export_merged_io.export(
-                    src_io=merged_io_read,
-                    nwbfile=export_nwbfile,
-                    write_args={"link_data": False},
-                )
-    
-    # we remove tmp file
-    os.remove(temp_merged_path)
-
-def _unicode(s: str | bytes):
-    """A helper function for converting a string or bytes object to Unicode."""
+            # NOTE in order to add elements from the NWB 2 file into a new file, the new file must
+            # first be created, then read, then have elements added to it, then exported to a new file.
+            # this is not the most efficient, but it works. export requires the exported NWBFile to have been
+            # read by src_io, so the round trip cannot be skipped.
+            # the stimulus templates and running speed are copied into the intermediate file, so if the intermediate
+            # file were kept in memory (HDF5 core driver), these copies would stay in process memory until the
+            # export is done. the intermediate file is kept in memory, so that it is never written to or read back
+            # from disk, only if these datasets are small. otherwise it is written to disk and removed at the end
+            temp_in_memory = (
+                _storage_size(old_templates) + _storage_size(old_processing["BehavioralTimeSeries/running_speed"])
+                <= _MAX_IN_MEMORY_TEMP_BYTES
+            )
+            if temp_in_memory:
+                temp_file = h5py.File(temp_merged_path, "w", driver="core", backing_store=False)
+            else:
+                temp_file = h5py.File(temp_merged_path, "w")
+            with temp_file:
+                # NOTE closing an NWBHDF5IO closes the h5py.File that was passed to it, which would discard the
+                # in-memory file, so the write IO is left open until the read IO closes temp_file
+                merged_io_write = NWBHDF5IO(temp_merged_path, "w", file=temp_file)
+                merged_io_write.write(out_nwbfile)
+
+                with NWBHDF5IO(temp_merged_path, "r", file=temp_file) as merged_io_read:
+                    export_nwbfile = merged_io_read.read()
+
+                    # TODO fix transpose of data in suite2p output
+                    # see https://github.com/MouseLand/suite2p/issues/909
+                    add_suite2p_output(export_nwbfile, in_nwbfile)
+                    if link_data:
+                        copy_reference_datasets(export_nwbfile)
+
+                    # NOTE if link_data is False, HDMF copies each h5py.Dataset, including the raw TwoPhotonSeries
+                    # data, with an HDF5 object copy (H5Ocopy). the chunks are copied as is, without being
+                    # decompressed, recompressed, or passed through Python, so no separate copy step is needed
+                    # the output file uses the HDF5 1.10 file format (more compact metadata and faster creation of
+                    # the many small groups) but not the "latest" format, so that it can be read with HDF5 1.10+
+                    with (
+                        h5py.File(export_path, "w", libver="v110") as export_file,
+                        NWBHDF5IO(export_path, "w", file=export_file) as export_merged_io,
+                    ):
+                        export_merged_io.export(
+                            src_io=merged_io_read,
+                            nwbfile=export_nwbfile,
+                            write_args={"link_data": link_data},
+                        )
+
+            if not temp_in_memory:
+                os.remove(temp_merged_path)
+
+
+def _unicode(s: str | bytes) -> str:
+    """A helper function for converting a string or bytes object to Unicode.
+
+    String datasets are read with h5py's asstr("utf-8"), which decodes them, so this is used for attributes.
+    """
+    # most strings in the NWB 1 file are read by h5py as bytes (or numpy.bytes_), so check for bytes first
+    if isinstance(s, bytes):
+        return s.decode("utf-8")
     if isinstance(s, str):
         return s
-    elif isinstance(s, bytes):
-        return s.decode("utf-8")
-    else:
-        raise ValueError("Expected unicode or ascii string, got %s" % type(s))
+    raise ValueError("Expected unicode or ascii string, got %s" % type(s))
+
+
+def _read_attrs(group: h5py.Group, names: tuple[str, ...]) -> dict[str, str]:
+    """A helper function for reading the given string attributes of an HDF5 group as Unicode."""
+    attrs = group.attrs
+    return {name: _unicode(attrs[name]) for name in names}
+
+
+def _storage_size(group: h5py.Group) -> int:
+    """A helper function for getting the number of bytes used to store the datasets in an HDF5 group."""
+    sizes = []
+
+    def add_size(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            sizes.append(obj.id.get_storage_size())
+
+    group.visititems(add_size)
+    return sum(sizes)
 
 
 def create_out_nwbfile(f: h5py.File, in_nwbfile: NWBFile) -> NWBFile:
@@ -89,7 +164,7 @@ def create_out_nwbfile(f: h5py.File, in_nwbfile: NWBFile) -> NWBFile:
 
     # artificially store history of when data were generated
     old_file_create_date = datetime.strptime(
-        _unicode(f["/file_create_date"][0]), strptime_format
+        f["/file_create_date"].asstr("utf-8")[0], strptime_format
     )
     old_file_create_date = in_nwbfile_tz.localize(old_file_create_date)
     file_create_date = [
@@ -99,32 +174,35 @@ def create_out_nwbfile(f: h5py.File, in_nwbfile: NWBFile) -> NWBFile:
     ]
 
     old_session_start_time = datetime.strptime(
-        _unicode(f["/session_start_time"][()]), strptime_format
+        f["/session_start_time"].asstr("utf-8")[()], strptime_format
     )
     old_session_start_time = in_nwbfile_tz.localize(old_session_start_time)
 
     # pynwb does not allow these values to be reset so create a new nwbfile
     out_nwbfile = NWBFile(
-        identifier=_unicode(f["/identifier"][()]),
-        session_description=_unicode(f["/session_description"][()]),
+        identifier=f["/identifier"].asstr("utf-8")[()],
+        session_description=f["/session_description"].asstr("utf-8")[()],
         file_create_date=file_create_date,
         session_start_time=old_session_start_time,
     )
     return out_nwbfile
 
 
-def add_running_speed_timeseries(out_nwbfile: NWBFile, f: h5py.File):
-    """Add running speed data from the NWB 1 file to the suite2p output NWB file."""
-    old_running_speed = f[
-        "/processing/brain_observatory_pipeline/BehavioralTimeSeries/running_speed"
-    ]
+def add_running_speed_timeseries(out_nwbfile: NWBFile, old_processing: h5py.Group):
+    """Add running speed data from the NWB 1 file to the suite2p output NWB file.
+
+    old_processing is the "/processing/brain_observatory_pipeline" group of the NWB 1 file.
+    """
+    old_running_speed = old_processing["BehavioralTimeSeries/running_speed"]
+    attrs = _read_attrs(old_running_speed, ("description", "comments"))
+    # the datasets are copied by HDF5 on write instead of being read into numpy arrays (see add_stimuli)
     ts = TimeSeries(
         name="running_speed",
-        data=old_running_speed["data"][:],
-        timestamps=old_running_speed["timestamps"][:],
+        data=H5DataIO(old_running_speed["data"]),
+        timestamps=H5DataIO(old_running_speed["timestamps"]),
         unit="frame",
-        description=_unicode(old_running_speed.attrs["description"]),
-        comments=_unicode(old_running_speed.attrs["comments"]),
+        description=attrs["description"],
+        comments=attrs["comments"],
     )
 
     behavioral_timeseries = BehavioralTimeSeries()
@@ -135,8 +213,12 @@ def add_running_speed_timeseries(out_nwbfile: NWBFile, f: h5py.File):
     behavior_module.add(behavioral_timeseries)
 
 
-def add_stimuli(out_nwbfile: NWBFile, f: h5py.File):
-    """Add presented stimuli from the NWB 1 file to the suite2p output NWB file."""
+def add_stimuli(out_nwbfile: NWBFile, old_templates: h5py.Group, old_presentations: h5py.Group):
+    """Add presented stimuli from the NWB 1 file to the suite2p output NWB file.
+
+    old_templates and old_presentations are the "/stimulus/templates" and "/stimulus/presentation" groups of the
+    NWB 1 file.
+    """
 
     def add_stimulus(template_name: str, presentation_name: str):
         # using an IndexSeries on a TimeSeries will result in a PendingDeprecationWarning from pynwb
@@ -159,31 +241,46 @@ def add_stimuli(out_nwbfile: NWBFile, f: h5py.File):
         #     lsn_stimulus_images.add_image(image)
         # in_nwbfile.add_stimulus_template(lsn_stimulus_images)
 
-        old_template = f[f"/stimulus/templates/{template_name}"]
+        # NOTE the h5py datasets are wrapped in H5DataIO instead of being read into numpy arrays. on write, HDF5
+        # copies the datasets directly from the NWB 1 file (keeping their chunking and compression) instead of pynwb
+        # writing a numpy array. this requires the NWB 1 file to stay open until the file is written. the copies
+        # are in the intermediate file, which is held in process memory if it is small (see main)
+        old_template = old_templates[template_name]
+        template_attrs = _read_attrs(old_template, ("description", "comments"))
         new_template = OpticalSeries(
             name=Path(old_template.name).name,
-            data=old_template["data"][:],
+            data=H5DataIO(old_template["data"]),
             dimension=old_template["dimension"][:],
             field_of_view=old_template["field_of_view"][:],
-            format=_unicode(old_template["format"][()]),
+            format=old_template["format"].asstr("utf-8")[()],
             starting_time=0.0,  # time is meaningless here
             rate=0.0,  # time is meaningless here
-            description=_unicode(old_template.attrs["description"][:]),
-            comments=_unicode(old_template.attrs["comments"][:]),
+            description=template_attrs["description"],
+            comments=template_attrs["comments"],
             distance=-1.0,  # placeholder
             orientation="N/A",  # placeholder
             unit="N/A",
         )
         out_nwbfile.add_stimulus_template(new_template)
 
-        old_presentation = f[f"/stimulus/presentation/{presentation_name}"]
+        old_presentation = old_presentations[presentation_name]
+        presentation_attrs = _read_attrs(old_presentation, ("description", "comments"))
+        # the indices must be cast to unsigned ints for an IndexSeries, so these are read into memory.
+        # NOTE casting a negative, NaN, or too large value to an unsigned int does not give a consistent invalid
+        # value (HDF5 clamps -1 to 0, a valid template frame, and numpy's result depends on the platform),
+        # so the indices are checked before the cast
+        presentation_data = old_presentation["data"][:]
+        if not np.all((presentation_data >= 0) & (presentation_data <= np.iinfo(np.uint32).max)):
+            raise ValueError(
+                f"Unexpected negative, NaN, or too large stimulus index in NWB 1 file: {old_presentation.name}"
+            )
         new_presentation = IndexSeries(
             name=Path(old_presentation.name).name,
-            data=old_presentation["data"][:].astype(np.uint32),
-            timestamps=old_presentation["timestamps"][:],
+            data=presentation_data.astype(np.uint32),
+            timestamps=H5DataIO(old_presentation["timestamps"]),
             indexed_timeseries=new_template,
-            description=_unicode(old_presentation.attrs["description"]),
-            comments=_unicode(old_presentation.attrs["comments"]),
+            description=presentation_attrs["description"],
+            comments=presentation_attrs["comments"],
             unit="N/A",
         )
         out_nwbfile.add_stimulus(new_presentation)
@@ -192,6 +289,9 @@ def add_stimuli(out_nwbfile: NWBFile, f: h5py.File):
         # stop_frame index for each presentation. this data does not have a corresponding place in the NWB 2 core
         # schema. this is currently omitted from the conversion. an extension could be written to include this data.
 
+    # NOTE the stimuli are added one at a time. the template data are not read here (they are copied by HDF5 when
+    # the file is written), and h5py holds a global lock around every HDF5 call, so adding them from a thread pool
+    # would not make reading the remaining data any faster
     add_stimulus(
         template_name="locally_sparse_noise_image_stack",
         presentation_name="locally_sparse_noise_stimulus",
@@ -206,13 +306,15 @@ def add_stimuli(out_nwbfile: NWBFile, f: h5py.File):
     )
 
     # spontaneous stimulus has no corresponding image stack
-    old_spont_presentation = f["/stimulus/presentation/spontaneous_stimulus"]
+    old_spont_presentation = old_presentations["spontaneous_stimulus"]
+    spont_attrs = _read_attrs(old_spont_presentation, ("description", "comments"))
     new_spont_presentation = IntervalSeries(
         name="spontaneous_stimulus",
+        # read into memory so that the data are converted to the integer type required by the NWB 2 schema
         data=old_spont_presentation["data"][:],
-        timestamps=old_spont_presentation["timestamps"][:],
-        description=_unicode(old_spont_presentation.attrs["description"][:]),
-        comments=_unicode(old_spont_presentation.attrs["comments"][:]),
+        timestamps=H5DataIO(old_spont_presentation["timestamps"]),
+        description=spont_attrs["description"],
+        comments=spont_attrs["comments"],
     )
     out_nwbfile.add_stimulus(new_spont_presentation)
     # NOTE the NWB 1 file contains frame_duration, which appears to be N x 2 representing the start_frame index and
@@ -221,34 +323,35 @@ def add_stimuli(out_nwbfile: NWBFile, f: h5py.File):
     # also note that for spontaneous_stimulus, start_frame == end_frame which seems incorrect
 
 
-def add_subject(in_nwbfile: NWBFile, f: h5py.File):
-    """Add subject information from the NWB 1 file to the suite2p output file."""
-    old_subject = f["/general/subject"]
+def add_subject(in_nwbfile: NWBFile, old_subject: h5py.Group):
+    """Add subject information from the NWB 1 file to the suite2p output file.
 
+    old_subject is the "/general/subject" group of the NWB 1 file.
+    """
     # change the value of sex to meet NWB 2 best practices
-    sex = _unicode(old_subject["sex"][()])
-    if sex == "male":
-        new_sex = "M"
-    elif sex == "female":
-        new_sex = "F"
-    else:
+    sex = old_subject["sex"].asstr("utf-8")[()]
+    new_sex = _SEX_MAP.get(sex)
+    if new_sex is None:
         raise ValueError(f"Unexpected value for subject 'sex' in NWB 1 file: {sex}")
 
     new_subject = Subject(
-        age=_unicode(old_subject["age"][()]),
-        description=_unicode(old_subject["description"][()]),
-        genotype=_unicode(old_subject["genotype"][()]),
+        age=old_subject["age"].asstr("utf-8")[()],
+        description=old_subject["description"].asstr("utf-8")[()],
+        genotype=old_subject["genotype"].asstr("utf-8")[()],
         sex=new_sex,
-        species=_unicode(old_subject["species"][()]),
-        subject_id=_unicode(old_subject["subject_id"][()]),
+        species=old_subject["species"].asstr("utf-8")[()],
+        subject_id=old_subject["subject_id"].asstr("utf-8")[()],
     )
     in_nwbfile.subject = new_subject
 
 
-def add_general(out_nwbfile: NWBFile, f: h5py.File):
-    """Add general metadata from the NWB 1 file to the suite2p output file."""
-    out_nwbfile.institution = _unicode(f["/general/institution"][()])
-    out_nwbfile.session_id = _unicode(f["/general/session_id"][()])
+def add_general(out_nwbfile: NWBFile, old_general: h5py.Group):
+    """Add general metadata from the NWB 1 file to the suite2p output file.
+
+    old_general is the "/general" group of the NWB 1 file.
+    """
+    out_nwbfile.institution = old_general["institution"].asstr("utf-8")[()]
+    out_nwbfile.session_id = old_general["session_id"].asstr("utf-8")[()]
     # NOTE for session id, there is a comment saying "ID corresponds to Allen Institute 'experiment_sessions ID'""
 
     # NOTE the NWB 1 file also contains the following datasets in "/general":
@@ -266,35 +369,60 @@ def add_general(out_nwbfile: NWBFile, f: h5py.File):
     # these data do not have a corresponding place in the NWB 2 core schema.
     # these are currently omitted from the conversion. an extension could be written to include these data.
 
-    for device_name in f["/general/devices"].keys():
-        out_nwbfile.create_device(name=device_name)
+    # list the device names in a single pass over the group, then add the devices
+    device_names = list(old_general["devices"])
+    devices = [Device(name=device_name) for device_name in device_names]
+    for device in devices:
+        out_nwbfile.add_device(device)
 
 
 def add_suite2p_output(out_nwbfile: NWBFile, in_nwbfile: NWBFile):
     """Copy the suite2p output data to the new NWB file."""
-    in_nwbfile.processing["ophys"].reset_parent()
-    out_nwbfile.add_processing_module(in_nwbfile.processing["ophys"])
-
-    in_nwbfile.acquisition["TwoPhotonSeries"].reset_parent()
-    out_nwbfile.add_acquisition(in_nwbfile.acquisition["TwoPhotonSeries"])
-
-    in_nwbfile.imaging_planes["ImagingPlane"].reset_parent()
-    out_nwbfile.add_imaging_plane(in_nwbfile.imaging_planes["ImagingPlane"])
+    # NOTE these groups are not replaced with HDF5 external links to the groups in the suite2p file. the ImagingPlane
+    # device link and the PlaneSegmentation reference images are changed below, and those changes cannot be made
+    # inside a linked group without modifying the suite2p file. the datasets in these groups, including the ROI
+    # columns of the PlaneSegmentation, are h5py.Datasets, so on export they are linked to or copied by HDF5
+    # and are not re-encoded in Python
+    # NOTE the containers are moved to the new NWBFile with reset_parent and add_*. they cannot be passed to the
+    # constructor of a single merged NWBFile instead, because export requires the exported NWBFile to have been
+    # read from the source file (see main)
+    ophys_module = in_nwbfile.processing["ophys"]
+    two_photon_series = in_nwbfile.acquisition["TwoPhotonSeries"]
+    imaging_plane = in_nwbfile.imaging_planes["ImagingPlane"]
+
+    ophys_module.reset_parent()
+    out_nwbfile.add_processing_module(ophys_module)
+
+    two_photon_series.reset_parent()
+    out_nwbfile.add_acquisition(two_photon_series)
+
+    imaging_plane.reset_parent()
+    out_nwbfile.add_imaging_plane(imaging_plane)
 
     # the suite2p output includes a dummy 2p microscope device. instead of using that one,
     # use the original device. but the device was already set, so we need to bypass the
     # pynwb restriction
-    out_nwbfile.imaging_planes["ImagingPlane"].fields.pop("device")
+    imaging_plane.fields.pop("device")
     # NOTE the following requires HDMF 3.4.8 to create the correct link
-    out_nwbfile.imaging_planes["ImagingPlane"].device = out_nwbfile.devices[
-        "2-photon microscope"
-    ]
+    imaging_plane.device = out_nwbfile.devices["2-photon microscope"]
 
     # remove the reference images from the PlaneSegmentation.
     # they have no useful data and will result in a broken link
-    out_nwbfile.processing["ophys"]["ImageSegmentation"][
-        "PlaneSegmentation"
-    ].reference_images.clear()
+    ophys_module["ImageSegmentation"]["PlaneSegmentation"].reference_images.clear()
+
+
+def copy_reference_datasets(out_nwbfile: NWBFile):
+    """Mark the suite2p datasets that hold object references to be copied even when the other datasets are linked.
+
+    The "table" attribute of a DynamicTableRegion and the "target" attribute of a VectorIndex are object references.
+    If such a dataset were written as an external link, these references would still point to the tables in the
+    suite2p file (or, after the reference images are removed, to objects that are not in the output file), and the
+    output file could not be read. When a dataset is copied, HDMF writes new references into the output file.
+    """
+    for obj in out_nwbfile.objects.values():
+        if isinstance(obj, (DynamicTableRegion, VectorIndex)) and isinstance(obj.data, h5py.Dataset):
+            # H5DataIO defaults to link_data=False, so the dataset is copied regardless of the export link_data
+            obj.transform(lambda data: H5DataIO(data))
 
 
 if __name__ == "__main__":
@@ -302,11 +430,14 @@ if __name__ == "__main__":
     parser.add_argument('--path_nwb_1', type=str, required=True)
     parser.add_argument('--path_nwb_2', type=str, required=True)
     parser.add_argument('--path_output', type=str, required=True)
+    parser.add_argument('--link_data', action='store_true',
+                        help='link to the suite2p datasets from the output file instead of copying them')
 
     args = parser.parse_args()
     path_nwb_1 = args.path_nwb_1
     path_nwb_2 = args.path_nwb_2
     path_output = args.path_output
+    link_data = args.link_data
 
 
-    main(path_nwb_1, path_nwb_2, path_output)
+    main(path_nwb_1, path_nwb_2, path_output, link_data)